@@ -4,32 +4,37 @@ Voice dictation using Groq's Whisper API.
 Hold the hotkey to record, release to transcribe and type.
 """
 
+import collections
+import io
 import subprocess
-import tempfile
 import threading
 import queue
 import os
+import re
 import sys
+import struct
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Load .env file
+ENV_LINE = re.compile(r'^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t]*$', re.MULTILINE)
+
+
 def load_env():
     env_path = Path(__file__).parent / ".env"
     if env_path.exists():
-        with open(env_path) as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith("#") and "=" in line:
-                    key, value = line.split("=", 1)
-                    os.environ.setdefault(key.strip(), value.strip())
+        # One regex pass; blank and comment lines never match
+        for key, value in ENV_LINE.findall(env_path.read_text()):
+            os.environ.setdefault(key, value)
 
 load_env()
 
 try:
     import numpy as np
     import sounddevice as sd
-    from groq import Groq
+    import httpx
+    from groq import DefaultHttpxClient, Groq
     from pynput import keyboard
     import gi
     gi.require_version('Gtk', '3.0')
@@ -48,9 +53,38 @@ if not os.environ.get("GROQ_API_KEY"):
 # Configuration
 SAMPLE_RATE = 16000
 CHANNELS = 1
-
-# Initialize Groq client
-client = Groq()
+MAX_SECONDS = 120  # longest recording; capture stops automatically here
+SILENCE_PEAK = 500  # int16 peak below which a recording is treated as silence
+SILENCE_RMS = 100  # loudest frame's int16 RMS below which a recording is silence
+SILENCE_FRAME = SAMPLE_RATE // 10  # samples per RMS frame (100 ms)
+LONG_RECORDING_SECONDS = 30  # recordings longer than this are split up
+CHUNK_SECONDS = 28  # length of each piece of a split recording
+CHUNK_OVERLAP_SECONDS = 2  # audio shared between neighbouring pieces
+MIN_CHUNK_SECONDS = 5  # shorter final pieces are merged into the one before
+MAX_OVERLAP_WORDS = 10  # most words dropped when stitching pieces together
+MAX_PARALLEL_UPLOADS = 4
+READ_SIZE = 1024  # frames per blocking read (64 ms); PortAudio waits in C, GIL released
+
+# WAV header for 16-bit PCM at our fixed format; sizes are filled in per upload
+WAV_HEADER = struct.pack(
+    '<4sI4s4sIHHIIHH4sI',
+    b'RIFF', 0, b'WAVE',
+    b'fmt ', 16, 1, CHANNELS, SAMPLE_RATE, SAMPLE_RATE * CHANNELS * 2, CHANNELS * 2, 16,
+    b'data', 0,
+)
+
+# Initialize Groq client, keeping idle connections open between dictations
+client = Groq(http_client=DefaultHttpxClient(
+    limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300.0),
+))
+
+
+def warm_up_connection():
+    """Open the connection to Groq ahead of the first transcription."""
+    try:
+        client.models.list()
+    except Exception as e:
+        print(f"Groq warm-up failed: {e}")
 
 # Custom icon paths
 SCRIPT_DIR = Path(__file__).parent
@@ -61,89 +95,198 @@ ICON_TRANSCRIBING = "mic-transcribing"
 ICON_ERROR = "mic-error"
 
 indicator = None
+current_icon = None
+tray_lock = threading.RLock()  # Keeps current_icon in step with what is posted to GTK
 
 
 def set_tray_status(icon_name):
-    """Update the tray icon."""
-    global indicator
-    if indicator:
-        GLib.idle_add(indicator.set_icon_full, icon_name, "Voice Dictation")
+    """Update the tray icon, skipping updates that would not change it."""
+    global indicator, current_icon
+    with tray_lock:
+        if indicator and icon_name != current_icon:
+            current_icon = icon_name
+            GLib.idle_add(indicator.set_icon_full, icon_name, "Voice Dictation")
 
 
-# Recording state
-recording = False
-typing_transcription = False  # True while xdotool is typing output
-audio_queue = queue.Queue()
-audio_data = []
-device_error = threading.Event()  # Signals device disconnection/error
+xdo_lock = threading.Lock()
 
 
-def audio_callback(indata, frames, time, status):
-    """Callback for audio recording."""
-    if status:
-        # Device error detected (disconnection, overflow, etc.)
-        print(f"Audio device error: {status}")
-        device_error.set()
-        return
-    if recording:
-        audio_queue.put(indata.copy())
+def xdo(*args):
+    """Run one xdotool command and wait for it to finish."""
+    with xdo_lock:
+        subprocess.run(["xdotool", *args], check=True)
+
+
+# Recording state
+recording = threading.Event()  # Set while audio is being captured
+stop_requested = threading.Event()  # Set on release; the capture loop finishes the take
+typing_transcription = False  # True while xdotool is typing output
+# Preallocated ring buffer filled by the capture loop (no per-chunk allocation)
+audio_buffer = np.empty((MAX_SECONDS * SAMPLE_RATE, CHANNELS), dtype=np.int16)
+write_index = 0
+buffer_lock = threading.Lock()  # Guards write_index and the recording/stop flags
+transcription_jobs = queue.Queue()  # Recorded audio waiting to be transcribed
+
+
+def append_audio(data):
+    """Copy a block of captured audio into the ring buffer while recording."""
+    global write_index
+    with buffer_lock:
+        # A block read across a stop still belongs to the take
+        if not (recording.is_set() or stop_requested.is_set()):
+            return
+        n = min(len(data), len(audio_buffer) - write_index)
+        audio_buffer[write_index:write_index + n] = data[:n]
+        write_index += n
+        if write_index == len(audio_buffer) and recording.is_set():
+            print(f"Recording reached {MAX_SECONDS} seconds, stopping")
+            recording.clear()
+            stop_requested.set()
 
 
 def start_recording():
     """Start recording audio."""
-    global recording, audio_data
-    audio_data = []
-    recording = True
-    set_tray_status(ICON_RECORDING)
+    global write_index
+    # Hand off a take whose final read has not completed yet
+    if stop_requested.is_set():
+        finish_recording()
+    with tray_lock:
+        with buffer_lock:
+            write_index = 0
+            recording.set()
+        set_tray_status(ICON_RECORDING)
 
 
 def stop_recording():
-    """Stop recording and process audio."""
-    global recording
-    recording = False
-
-    # Collect all audio data from queue
-    while not audio_queue.empty():
-        audio_data.append(audio_queue.get())
+    """Stop recording; the capture loop hands off the audio after its current read."""
+    with buffer_lock:
+        if recording.is_set():
+            recording.clear()
+            stop_requested.set()
+
+
+def finish_recording():
+    """Process the audio of a stopped recording."""
+    global write_index
+    with buffer_lock:
+        if not stop_requested.is_set():
+            return
+        stop_requested.clear()
+        audio = audio_buffer[:write_index].copy()
+        write_index = 0
+
+    if not len(audio):
+        set_idle_status()
+        return
 
-    if not audio_data:
-        set_tray_status(ICON_IDLE)
+    # Skip the upload entirely for silent recordings (e.g. accidental taps).
+    # RMS is taken per frame so pauses in a long take don't dilute speech.
+    samples = audio.reshape(-1).astype(np.float32)
+    frames = max(1, len(samples) // SILENCE_FRAME)
+    framed = samples[:frames * SILENCE_FRAME] if len(samples) >= SILENCE_FRAME else samples
+    peak = np.abs(samples).max()
+    rms = np.sqrt(np.mean(np.square(framed.reshape(frames, -1)), axis=1)).max()
+    if peak < SILENCE_PEAK or rms < SILENCE_RMS:
+        print(f"Recording was silent (peak {peak:.0f}, RMS {rms:.0f}), skipping")
+        set_idle_status()
         return
 
-    # Combine audio chunks
-    audio = np.concatenate(audio_data)
-    set_tray_status(ICON_TRANSCRIBING)
-    transcribe_and_type(audio)
+    # Hand off to the worker so capture is never blocked on the network
+    with tray_lock:
+        transcription_jobs.put(audio)
+        set_tray_status(ICON_TRANSCRIBING)
+
+
+def transcription_worker():
+    """Transcribe recordings one at a time as they are queued."""
+    while True:
+        audio = transcription_jobs.get()
+        transcribe_and_type(audio)
+        transcription_jobs.task_done()
+        set_idle_status()
+
+
+def set_idle_status():
+    """Show the idle icon, unless still recording or transcribing."""
+    with tray_lock:
+        if recording.is_set():
+            return
+        set_tray_status(ICON_TRANSCRIBING if transcription_jobs.unfinished_tasks else ICON_IDLE)
+
+
+def transcribe_chunk(audio: np.ndarray) -> str:
+    """Upload one piece of audio to Groq and return its transcription."""
+    # Build the WAV in memory; BytesIO has no fileno(), so it never touches disk
+    with io.BytesIO() as buf:
+        pcm = memoryview(audio).cast('B')  # No copy of the samples
+        header = bytearray(WAV_HEADER)
+        struct.pack_into('<I', header, 4, 36 + len(pcm))  # RIFF chunk size
+        struct.pack_into('<I', header, 40, len(pcm))  # data chunk size
+        buf.write(header)
+        buf.write(pcm)
+        buf.seek(0)
+
+        transcription = client.audio.transcriptions.create(
+            model="whisper-large-v3",
+            file=("audio.wav", buf),
+        )
+    return transcription.text.strip()
+
+
+def merge_overlap(previous: str, text: str) -> str:
+    """Drop words at the start of text that repeat the end of previous."""
+    prev_words = [w.strip(".,!?;:").lower() for w in previous.split()]
+    words = text.split()
+    next_words = [w.strip(".,!?;:").lower() for w in words]
+    for n in range(min(len(prev_words), len(next_words), MAX_OVERLAP_WORDS), 0, -1):
+        if prev_words[-n:] == next_words[:n]:
+            return " ".join(words[n:])
+    return text
+
+
+def transcribe(audio: np.ndarray) -> str:
+    """Transcribe audio, splitting long recordings into parallel requests."""
+    if len(audio) <= LONG_RECORDING_SECONDS * SAMPLE_RATE:
+        return transcribe_chunk(audio)
+
+    # Overlapping windows so words at a boundary are heard whole in one of them
+    size = CHUNK_SECONDS * SAMPLE_RATE
+    overlap = CHUNK_OVERLAP_SECONDS * SAMPLE_RATE
+    starts = list(range(0, len(audio) - overlap, size - overlap))
+    # Fold a short tail into the previous window; Whisper invents text on tiny clips
+    if len(starts) > 1 and len(audio) - starts[-1] < MIN_CHUNK_SECONDS * SAMPLE_RATE:
+        starts.pop()
+    ends = [start + size for start in starts[:-1]] + [len(audio)]
+    chunks = [audio[start:end] for start, end in zip(starts, ends)]
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_UPLOADS) as executor:
+        texts = list(executor.map(transcribe_chunk, chunks))
+
+    result = ""
+    for text in texts:
+        if not text:
+            continue
+        result = f"{result} {merge_overlap(result, text)}".strip() if result else text
+    return result
+
+
+def wait_for_tap_keys():
+    """Wait until no tap key is held, so its BackSpaces cannot land mid-typing."""
+    while any(handler.press_time is not None for handler in tap_handlers.values()):
+        time.sleep(0.02)
 
 
 def transcribe_and_type(audio: np.ndarray):
     """Send audio to Groq and type the result."""
     global typing_transcription
-    # Save to temporary WAV file
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
-        temp_path = f.name
-        import wave
-        with wave.open(f.name, 'wb') as wav:
-            wav.setnchannels(CHANNELS)
-            wav.setsampwidth(2)  # 16-bit
-            wav.setframerate(SAMPLE_RATE)
-            wav.writeframes((audio * 32767).astype(np.int16).tobytes())
-
     try:
-        # Send to Groq
-        with open(temp_path, "rb") as audio_file:
-            transcription = client.audio.transcriptions.create(
-                model="whisper-large-v3",
-                file=audio_file,
-            )
-
-        text = transcription.text.strip()
+        text = transcribe(audio)
         if text:
             text += " "  # Add trailing space
-            transcription_stack.append(text)
-            # Type using xdotool (ignore synthetic key events during this)
+            transcription_lengths.append(len(text))
+            # Type using xdotool (ignore tap key presses during this, they may be synthetic)
             typing_transcription = True
-            subprocess.run(["xdotool", "type", "--clearmodifiers", "--", text], check=True)
+            wait_for_tap_keys()
+            xdo("type", "--clearmodifiers", "--", text)
             typing_transcription = False
 
     except Exception as e:
@@ -151,126 +294,136 @@ def transcribe_and_type(audio: np.ndarray):
 
     finally:
         typing_transcription = False
-        os.unlink(temp_path)
-        set_tray_status(ICON_IDLE)
 
 
 HOTKEY = keyboard.Key.pause
-BACKTICK_HOLD_THRESHOLD = 0.3  # seconds - hold longer than this to record
+# Plain and dead-key (e.g. US-International) backtick; KeyCode equality checks is_dead
+BACKTICK_KEYS = (keyboard.KeyCode.from_char('`'), keyboard.KeyCode.from_dead('`'))
+TAP_HOLD_THRESHOLD = 0.3  # seconds - hold longer than this to record
 DOUBLE_TAP_THRESHOLD = 0.3  # seconds - tap twice within this to undo
 
-# Backtick state
-backtick_press_time = None
-backtick_timer = None
-last_backtick_tap_time = None
+transcription_lengths = collections.deque(maxlen=128)  # Typed lengths, for undo
 
-transcription_stack = []
+
+def undo_last_transcription():
+    """Delete the last transcription by sending backspaces."""
+    if transcription_lengths:
+        length = transcription_lengths.pop()
+        # Send all backspaces in a single xdotool invocation
+        xdo("key", "--repeat", str(length), "--delay", "0", "BackSpace")
+
+
+class TapHandler:
+    """Hold a character key to record; tap to type it, double-tap to undo."""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.press_time = None
+        self.timer = None
+        self.last_tap_time = None
+
+    def on_press(self):
+        """Start a timer for hold detection."""
+        if not recording.is_set():
+            self.press_time = time.time()
+            # Start a timer to begin recording after threshold
+            self.timer = threading.Timer(TAP_HOLD_THRESHOLD, self._on_hold)
+            self.timer.start()
+
+    def _on_hold(self):
+        """Called when the key is held long enough."""
+        if self.press_time is not None:
+            # Delete the character that was typed
+            xdo("key", "BackSpace")
+            start_recording()
+
+    def on_release(self):
+        """Stop recording after a hold, or handle a tap."""
+        # Cancel the timer if still running
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.press_time is None:
+            return
+        held_duration = time.time() - self.press_time
+        self.press_time = None
+
+        if recording.is_set():
+            # Was held long enough, stop recording
+            stop_recording()
+        elif held_duration < TAP_HOLD_THRESHOLD:
+            # Quick tap - check for double-tap
+            now = time.time()
+            if self.last_tap_time and (now - self.last_tap_time) < DOUBLE_TAP_THRESHOLD:
+                # Double-tap detected - delete both characters and undo
+                xdo("key", "BackSpace", "BackSpace")
+                undo_last_transcription()
+                self.last_tap_time = None
+            else:
+                # Single tap - record time for potential double-tap
+                self.last_tap_time = now
+
+
+# Each KeyCode maps to its handler (KeyCode hashes by char, consistent with ==)
+tap_handlers = {key: handler for handler in [TapHandler(BACKTICK_KEYS)] for key in handler.keys}
 
 
 def on_press(key):
     """Handle key press."""
-    global recording, backtick_press_time, backtick_timer
-
-    # Ignore synthetic key events from xdotool typing transcription
-    if typing_transcription:
-        return
-
-    # Pause key - immediate recording
-    if key == HOTKEY and not recording:
+    # Pause key - immediate recording (xdotool never types it)
+    if key == HOTKEY and not recording.is_set():
         start_recording()
         return
 
-    # Backtick - start timer for hold detection
-    if getattr(key, 'char', None) == '`' and not recording:
-        backtick_press_time = time.time()
-        # Start a timer to begin recording after threshold
-        backtick_timer = threading.Timer(BACKTICK_HOLD_THRESHOLD, start_recording_from_backtick)
-        backtick_timer.start()
-
-
-def start_recording_from_backtick():
-    """Called when backtick is held long enough."""
-    global backtick_press_time
-    if backtick_press_time is not None:
-        # Delete the backtick that was typed
-        subprocess.run(["xdotool", "key", "BackSpace"], check=True)
-        start_recording()
-
+    # Tap keys may be synthetic while xdotool is typing a transcription
+    if typing_transcription:
+        return
 
-def undo_last_transcription():
-    """Delete the last transcription by sending backspaces."""
-    if transcription_stack:
-        text = transcription_stack.pop()
-        # Send backspaces to delete the text
-        for _ in range(len(text)):
-            subprocess.run(["xdotool", "key", "BackSpace"], check=True)
+    handler = tap_handlers.get(key)
+    if handler:
+        handler.on_press()
 
 
 def on_release(key):
     """Handle key release."""
-    global recording, backtick_press_time, backtick_timer, last_backtick_tap_time
-
-    # Ignore synthetic key events from xdotool typing transcription
-    if typing_transcription:
-        return
+    # Releases are handled even while typing: a tap key release only acts
+    # after an accepted press, so synthetic releases fall through harmlessly
 
     # Pause key release
-    if key == HOTKEY and recording:
+    if key == HOTKEY and recording.is_set():
         stop_recording()
         return
 
-    # Backtick release
-    if getattr(key, 'char', None) == '`':
-        # Cancel the timer if still running
-        if backtick_timer is not None:
-            backtick_timer.cancel()
-            backtick_timer = None
-
-        if backtick_press_time is not None:
-            held_duration = time.time() - backtick_press_time
-            backtick_press_time = None
-
-            if recording:
-                # Was held long enough, stop recording
-                stop_recording()
-            elif held_duration < BACKTICK_HOLD_THRESHOLD:
-                # Quick tap - check for double-tap
-                now = time.time()
-                if last_backtick_tap_time and (now - last_backtick_tap_time) < DOUBLE_TAP_THRESHOLD:
-                    # Double-tap detected - delete both backticks and undo
-                    subprocess.run(["xdotool", "key", "BackSpace", "BackSpace"], check=True)
-                    undo_last_transcription()
-                    last_backtick_tap_time = None
-                else:
-                    # Single tap - record time for potential double-tap
-                    last_backtick_tap_time = now
+    handler = tap_handlers.get(key)
+    if handler:
+        handler.on_release()
 
 
 def run_dictation():
     """Run the dictation logic with automatic device reconnection."""
-    global recording
+    global write_index
     RECONNECT_DELAY = 2.0  # seconds to wait before reconnecting
 
     with keyboard.Listener(on_press=on_press, on_release=on_release) as listener:
         while listener.running:
-            device_error.clear()
             try:
                 print("Opening audio device...")
+                # Blocking reads on this thread keep Python off PortAudio's realtime thread
+                # Default (high) input latency gives the host buffer room to
+                # absorb GIL stalls between reads
                 with sd.InputStream(samplerate=SAMPLE_RATE, channels=CHANNELS,
-                                    callback=audio_callback, dtype=np.float32):
+                                    dtype=np.int16) as stream:
                     print("Audio device ready")
                     set_tray_status(ICON_IDLE)
-                    # Wait for device error or listener to stop
-                    while listener.running and not device_error.is_set():
-                        device_error.wait(timeout=0.5)
-
-                    if device_error.is_set():
-                        print("Device error detected, will reconnect...")
-                        # Reset recording state
-                        recording = False
-                        # Clear any stale audio data
-                        while not audio_queue.empty():
-                            audio_queue.get()
+                    # Capture until the listener stops; device errors raise
+                    while listener.running:
+                        data, overflowed = stream.read(READ_SIZE)
+                        if overflowed:
+                            print("Audio input overflow, some samples were dropped")
+                        append_audio(data)
+                        if stop_requested.is_set():
+                            finish_recording()
             except sd.PortAudioError as e:
                 print(f"Audio device error: {e}")
             except Exception as e:
@@ -278,6 +431,11 @@ def run_dictation():
 
             # If we get here, either device errored or listener stopped
             if listener.running:
+                # Reset recording state and discard stale audio
+                with buffer_lock:
+                    recording.clear()
+                    stop_requested.clear()
+                    write_index = 0
                 set_tray_status(ICON_ERROR)
                 print(f"Reconnecting in {RECONNECT_DELAY} seconds...")
                 time.sleep(RECONNECT_DELAY)
@@ -295,7 +453,7 @@ def on_quit(source):
 
 
 def main():
-    global indicator
+    global indicator, current_icon
 
     print(f"Voice dictation ready!")
     print(f"Hold Pause or backtick (`) to record")
@@ -311,6 +469,7 @@ def main():
         AppIndicator3.IndicatorCategory.APPLICATION_STATUS
     )
     indicator.set_icon_theme_path(ICON_DIR)
+    current_icon = ICON_IDLE
     indicator.set_status(AppIndicator3.IndicatorStatus.ACTIVE)
 
     # Create menu
@@ -324,6 +483,13 @@ def main():
     menu.show_all()
     indicator.set_menu(menu)
 
+    # Establish the Groq connection in the background
+    threading.Thread(target=warm_up_connection, daemon=True).start()
+
+    # Run transcription in a background worker
+    worker_thread = threading.Thread(target=transcription_worker, daemon=True)
+    worker_thread.start()
+
     # Run dictation in a separate thread
     dictation_thread = threading.Thread(target=run_dictation, daemon=True)
     dictation_thread.start()
@@ -44,7 +44,7 @@ fi
 
 # Install dependencies
 echo "Installing Python dependencies..."
-./venv/bin/pip install -q groq sounddevice numpy pynput
+./venv/bin/pip install -q groq httpx sounddevice numpy pynput
 
 # Check for .env
 if [ ! -f ".env" ]; then